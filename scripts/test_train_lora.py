@@ -0,0 +1,116 @@
+"""
+Tests for scripts/train_lora.py dataset tokenization
+
+Skipped unless the training dependencies (scripts/requirements.txt) are
+installed. Uses a small offline byte-level BPE tokenizer with Qwen2's
+pre-tokenizer split and a ChatML template, so no model download is needed.
+
+Usage:
+    python3 -m pytest scripts/test_train_lora.py
+"""
+
+import importlib.util
+from pathlib import Path
+
+import pytest
+
+for dep in ("torch", "numpy", "transformers", "peft", "safetensors", "tokenizers"):
+    pytest.importorskip(dep)
+
+_spec = importlib.util.spec_from_file_location("train_lora", Path(__file__).with_name("train_lora.py"))
+train_lora = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(train_lora)
+
+# Qwen2's pre-tokenizer split; `\s*[\r\n]+` merges a frame's trailing
+# newline with a leading newline in the message content
+QWEN2_SPLIT = (
+    r"(?i:'s|'t|'re|'ve|'m|'ll|'d)|[^\r\n\p{L}\p{N}]?\p{L}+|\p{N}"
+    r"| ?[^\s\p{L}\p{N}]+[\r\n]*|\s*[\r\n]+|\s+(?!\S)|\s+"
+)
+CHATML = (
+    "{% for m in messages %}<|im_start|>{{ m['role'] }}\n{{ m['content'] }}<|im_end|>\n{% endfor %}"
+    "{% if add_generation_prompt %}<|im_start|>assistant\n{% endif %}"
+)
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    from tokenizers import Regex, Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import PreTrainedTokenizerFast
+
+    tok = Tokenizer(models.BPE())
+    tok.pre_tokenizer = pre_tokenizers.Sequence([
+        pre_tokenizers.Split(Regex(QWEN2_SPLIT), behavior="isolated"),
+        pre_tokenizers.ByteLevel(add_prefix_space=False, use_regex=False),
+    ])
+    tok.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=400,
+        special_tokens=["<|endoftext|>", "<|im_start|>", "<|im_end|>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    )
+    tok.train_from_iterator(
+        ["You are Qwen, a helpful AI assistant.", "system user assistant", "hi hello there\n\nHello world"],
+        trainer,
+    )
+
+    fast = PreTrainedTokenizerFast(
+        tokenizer_object=tok,
+        pad_token="<|endoftext|>",
+        additional_special_tokens=["<|im_start|>", "<|im_end|>"],
+    )
+    fast.chat_template = CHATML
+    return fast
+
+
+def expected_row(tokenizer, example, max_length):
+    """Token ids and prompt length from tokenizing the rendered chat text"""
+    messages = train_lora.chat_messages(example["query"], example["response"])
+    text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=False)
+    prompt = tokenizer.apply_chat_template(
+        train_lora.chat_messages(example["query"]), tokenize=False, add_generation_prompt=True
+    )
+    ids = tokenizer(text, truncation=True, max_length=max_length)["input_ids"]
+    prompt_ids = tokenizer(prompt, truncation=True, max_length=max_length)["input_ids"]
+    return ids, len(prompt_ids)
+
+
+def dataset_rows(dataset):
+    return [
+        (dataset.input_ids[dataset.offsets[i]:dataset.offsets[i + 1]].tolist(), dataset.prompt_lengths[i].item())
+        for i in range(len(dataset))
+    ]
+
+
+def test_all_rows_whitespace_leading(tokenizer):
+    examples = [
+        {"query": "hi", "response": "\n\nHello"},
+        {"query": "\nhello there", "response": "world"},
+    ]
+    dataset = train_lora.WeightedExampleDataset(examples, tokenizer, max_length=128)
+
+    assert dataset_rows(dataset) == [expected_row(tokenizer, ex, 128) for ex in examples]
+
+
+def test_whitespace_rows_deferred_to_later_chunk(tokenizer):
+    # First chunk has no concat-safe rows; the second does
+    examples = [
+        {"query": "hi", "response": "\n\nHello"},
+        {"query": "hello", "response": "there world", "weight": 3.0},
+        {"query": " hi", "response": "\nworld"},
+    ]
+    dataset = train_lora.WeightedExampleDataset(examples, tokenizer, max_length=128, chunk_size=1)
+
+    assert dataset_rows(dataset) == [expected_row(tokenizer, ex, 128) for ex in examples]
+    assert dataset.weights.tolist() == [1.0, 3.0, 1.0]
+
+
+def test_mixed_rows_keep_order(tokenizer):
+    examples = [
+        {"query": "hello", "response": "world"},
+        {"query": "hi", "response": "\n\nHello"},
+        {"query": "there", "response": "hello world"},
+    ]
+    dataset = train_lora.WeightedExampleDataset(examples, tokenizer, max_length=128)
+
+    assert dataset_rows(dataset) == [expected_row(tokenizer, ex, 128) for ex in examples]
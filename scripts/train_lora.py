@@ -16,124 +16,685 @@ Example:
 """
 
 import argparse
+import functools
+import hashlib
+import importlib.util
+import itertools
 import json
+import mmap
+import os
+import random
+import struct
 import sys
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterable, Iterator, Optional
 
 try:
+    import orjson
+    _json_loads = orjson.loads  # ~5x faster than stdlib json on large queues
+except ImportError:
+    _json_loads = json.loads
+
+try:
+    import numpy as np
     import torch
-    from torch.utils.data import Dataset, DataLoader
+    from torch.utils.data import Dataset, DataLoader, Sampler
     from transformers import (
         AutoModelForCausalLM,
         AutoTokenizer,
+        BitsAndBytesConfig,
         TrainingArguments,
         Trainer,
-        DataCollatorForLanguageModeling,
+        DataCollatorForSeq2Seq,
     )
     from peft import (
         LoraConfig,
         get_peft_model,
+        get_peft_model_state_dict,
+        prepare_model_for_kbit_training,
         TaskType,
         PeftModel,
     )
-    from safetensors.torch import save_file
+    from safetensors.torch import load_file
 except ImportError as e:
     print(f"Error: Missing required package: {e}", file=sys.stderr)
     print("\nPlease install dependencies:", file=sys.stderr)
-    print("  pip install torch transformers peft safetensors accelerate", file=sys.stderr)
+    print("  pip install torch numpy transformers peft safetensors accelerate", file=sys.stderr)
     sys.exit(1)
 
 
+# Bump when the cached tokenization layout or chat formatting changes
+TOKENIZE_CACHE_VERSION = 7
+
+# Cache file names start with this; eviction only ever touches these files
+TOKENIZE_CACHE_PREFIX = "tok-"
+
+SYSTEM_PROMPT = "You are Qwen, a helpful AI assistant."
+
+
+def chat_messages(query: str, response: Optional[str] = None) -> List[Dict[str, str]]:
+    """Build the system + user (+ assistant) turns for one example"""
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": query},
+    ]
+    if response is not None:
+        messages.append({"role": "assistant", "content": response})
+    return messages
+
+
+class ChatTemplate:
+    """Chat template rendered once, then filled per row by concatenation
+
+    apply_chat_template builds and runs a sandboxed Jinja template on every
+    call. Rendering it once with sentinel contents captures the fixed text
+    around the query and response, which is all that varies between rows.
+    The fixed text is also tokenized once so rows can be encoded by
+    concatenating token ids (see encode()).
+    """
+
+    QUERY = "\x00QUERY\x00"
+    RESPONSE = "\x00RESPONSE\x00"
+
+    def __init__(self, tokenizer):
+        full = tokenizer.apply_chat_template(
+            chat_messages(self.QUERY, self.RESPONSE), tokenize=False, add_generation_prompt=False
+        )
+        prompt = tokenizer.apply_chat_template(
+            chat_messages(self.QUERY), tokenize=False, add_generation_prompt=True
+        )
+        if full.count(self.QUERY) != 1 or full.count(self.RESPONSE) != 1 or prompt.count(self.QUERY) != 1:
+            raise ValueError("chat template does not embed message contents verbatim")
+
+        self.prefix, rest = full.split(self.QUERY)
+        self.middle, self.suffix = rest.split(self.RESPONSE)
+        prompt_prefix, self.generation_suffix = prompt.split(self.QUERY)
+        if prompt_prefix != self.prefix or self.RESPONSE in self.middle:
+            raise ValueError("chat template prompt and conversation renderings disagree")
+
+        def frame_ids(text: str) -> List[int]:
+            return tokenizer(text, add_special_tokens=False)["input_ids"]
+
+        self.prefix_ids = frame_ids(self.prefix)
+        self.middle_ids = frame_ids(self.middle)
+        self.suffix_ids = frame_ids(self.suffix)
+        generation_ids = frame_ids(self.generation_suffix)
+
+        # The prompt (for loss masking) ends where the assistant header ends,
+        # which is only a token boundary inside middle_ids if the generation
+        # suffix tokenizes as a prefix of it (true for Qwen's ChatML)
+        self.prompt_suffix_len = None
+        if self.middle_ids[:len(generation_ids)] == generation_ids:
+            self.prompt_suffix_len = len(generation_ids)
+
+    def render(self, query: str, response: str) -> str:
+        return f"{self.prefix}{query}{self.middle}{response}{self.suffix}"
+
+    def render_prompt(self, query: str) -> str:
+        return f"{self.prefix}{query}{self.generation_suffix}"
+
+    def matches(self, tokenizer, examples: List[Dict[str, Any]], sample_size: int = 16) -> bool:
+        """Check rendering against apply_chat_template on a random subset"""
+        sample = random.Random(0).sample(examples, min(sample_size, len(examples)))
+        for ex in sample:
+            expected = tokenizer.apply_chat_template(
+                chat_messages(ex["query"], ex["response"]), tokenize=False, add_generation_prompt=False
+            )
+            expected_prompt = tokenizer.apply_chat_template(
+                chat_messages(ex["query"]), tokenize=False, add_generation_prompt=True
+            )
+            if self.render(ex["query"], ex["response"]) != expected or self.render_prompt(ex["query"]) != expected_prompt:
+                return False
+        return True
+
+    @staticmethod
+    def concat_safe(example: Dict[str, Any]) -> bool:
+        """Whether encode() tokenizes this row exactly like its rendered text
+
+        Frames end in a newline, and pre-tokenizers such as Qwen2's merge it
+        with leading whitespace containing a newline (e.g. into one "\\n\\n"
+        token), so rows whose query or response starts with whitespace must
+        be tokenized from rendered text.
+        """
+        return not example["query"][:1].isspace() and not example["response"][:1].isspace()
+
+    def encode(self, tokenizer, examples: List[Dict[str, Any]], max_length: int):
+        """Encode rows by concatenating frame ids with query/response ids
+
+        Only the variable query and response strings go through the
+        tokenizer. Returns (input_ids, prompt_lengths), truncated to
+        max_length. Rows must satisfy concat_safe().
+        """
+        queries = tokenizer([ex["query"] for ex in examples], add_special_tokens=False)["input_ids"]
+        responses = tokenizer([ex["response"] for ex in examples], add_special_tokens=False)["input_ids"]
+
+        input_ids = []
+        prompt_lengths = []
+        for q_ids, r_ids in zip(queries, responses):
+            ids = self.prefix_ids + q_ids + self.middle_ids + r_ids + self.suffix_ids
+            input_ids.append(ids[:max_length])
+            prompt_lengths.append(min(len(self.prefix_ids) + len(q_ids) + self.prompt_suffix_len, max_length))
+        return input_ids, prompt_lengths
+
+    def encode_matches(
+        self, tokenizer, examples: List[Dict[str, Any]], max_length: int, sample_size: int = 16
+    ) -> Optional[bool]:
+        """Check encode() against tokenizing the rendered text on a random subset
+
+        Returns None if no example is concat_safe(), i.e. nothing to check yet.
+        """
+        if self.prompt_suffix_len is None:
+            return False
+        examples = [ex for ex in examples if self.concat_safe(ex)]
+        if not examples:
+            return None
+        sample = random.Random(0).sample(examples, min(sample_size, len(examples)))
+        input_ids, prompt_lengths = self.encode(tokenizer, sample, max_length)
+        expected = tokenizer(
+            [self.render(ex["query"], ex["response"]) for ex in sample], truncation=True, max_length=max_length
+        )["input_ids"]
+        expected_prompts = tokenizer(
+            [self.render_prompt(ex["query"]) for ex in sample], truncation=True, max_length=max_length
+        )["input_ids"]
+        return input_ids == expected and prompt_lengths == [len(ids) for ids in expected_prompts]
+
+
 class WeightedExampleDataset(Dataset):
     """Dataset that samples examples proportional to their weight"""
 
-    def __init__(self, examples: List[Dict[str, Any]], tokenizer, max_length: int = 512):
-        self.examples = examples
+    def __init__(
+        self,
+        examples: Iterable[Dict[str, Any]],
+        tokenizer,
+        max_length: int = 512,
+        cache_path: Optional[Path] = None,
+        chunk_size: int = 1000,
+    ):
         self.tokenizer = tokenizer
         self.max_length = max_length
 
+        # Token ids are stored CSR-style: one flat tensor plus row offsets.
+        # On a cache hit the examples iterable is never consumed.
+        tensors = None
+        if cache_path is not None and cache_path.exists():
+            try:
+                tensors = load_file(str(cache_path), device="cpu")  # memory-mapped
+                print(f"  Loaded tokenized dataset from cache: {cache_path}")
+            except Exception as e:
+                print(f"Warning: Ignoring unreadable tokenize cache {cache_path}: {e}", file=sys.stderr)
+        if tensors is None:
+            tensors = self._tokenize(examples, chunk_size)
+            if cache_path is not None and save_tokenize_cache(tensors, cache_path):
+                # Swap the in-memory tensors for the memory-mapped file so the
+                # corpus isn't held in RAM for the whole training run
+                tensors = load_file(str(cache_path), device="cpu")
+
+        self.input_ids = tensors["input_ids"]
+        self.offsets = tensors["offsets"]
+        self.prompt_lengths = tensors["prompt_lengths"]
+        self.lengths = (self.offsets[1:] - self.offsets[:-1]).tolist()
+
         # Build sampling weights (weight field in each example)
-        self.weights = [ex.get("weight", 1.0) for ex in examples]
-        self.total_weight = sum(self.weights)
-
-        # Tokenize all examples upfront
-        self.tokenized_examples = []
-        for ex in examples:
-            # Format as chat (system + user → assistant)
-            chat = [
-                {"role": "system", "content": "You are Qwen, a helpful AI assistant."},
-                {"role": "user", "content": ex["query"]},
-                {"role": "assistant", "content": ex["response"]},
-            ]
-
-            # Apply chat template
-            text = self.tokenizer.apply_chat_template(
-                chat,
-                tokenize=False,
-                add_generation_prompt=False,
-            )
+        self.weights = tensors["weights"].numpy()
+        self.total_weight = float(self.weights.sum())
+        self.alias_prob, self.alias = build_alias_table(self.weights)
+
+    def _tokenize(self, examples: Iterable[Dict[str, Any]], chunk_size: int) -> Dict[str, torch.Tensor]:
+        """Tokenize examples into flat int32 input_ids plus row offsets
+
+        Examples are consumed chunk by chunk, so only one chunk of raw text is
+        held at a time. Also records each row's sampling weight and prompt
+        length (system + user turns and the assistant header) so the loss
+        can be restricted to the response.
+        """
+        # int32 ids halve the cache; vocab sizes are far below 2**31
+        parts_dtypes = {"input_ids": torch.int32, "lengths": torch.long, "prompt_lengths": torch.long, "weights": torch.float64}
+        parts = {key: [] for key in parts_dtypes}
+        template = None
+        concat_ids = None  # Decided on the first chunk with a concat-safe row
+        dropped = 0
+        examples = iter(examples)
+        while chunk := list(itertools.islice(examples, chunk_size)):
+            if not parts["weights"]:
+                template = self._chat_template(chunk)
+            if template is not None and concat_ids is None:
+                concat_ids = template.encode_matches(self.tokenizer, chunk, self.max_length)
+                if concat_ids is False:
+                    print("Warning: Tokenizing rendered chat text (frame token ids don't concatenate cleanly)", file=sys.stderr)
 
-            # Tokenize
-            encoded = self.tokenizer(
-                text,
-                truncation=True,
-                max_length=self.max_length,
-                padding="max_length",
-                return_tensors="pt",
+            input_ids, prompt_lengths = self._encode(chunk, template, bool(concat_ids))
+
+            # Skip rows whose prompt fills max_length: with every label masked
+            # they contribute no loss, and a batch made only of them is NaN
+            weights = example_weights(chunk)
+            keep = [i for i, (ids, p) in enumerate(zip(input_ids, prompt_lengths)) if p < len(ids)]
+            if len(keep) < len(chunk):
+                dropped += len(chunk) - len(keep)
+                input_ids = [input_ids[i] for i in keep]
+                prompt_lengths = [prompt_lengths[i] for i in keep]
+                weights = weights[keep]
+
+            parts["input_ids"].append(torch.tensor(list(itertools.chain.from_iterable(input_ids)), dtype=torch.int32))
+            parts["lengths"].append(torch.tensor([len(ids) for ids in input_ids], dtype=torch.long))
+            parts["prompt_lengths"].append(torch.tensor(prompt_lengths, dtype=torch.long))
+            parts["weights"].append(torch.from_numpy(weights))
+
+        if dropped:
+            print(
+                f"Warning: Skipped {dropped} example(s) with no response tokens within "
+                f"max_length={self.max_length} (query too long)",
+                file=sys.stderr,
             )
 
-            self.tokenized_examples.append({
-                "input_ids": encoded["input_ids"].squeeze(0),
-                "attention_mask": encoded["attention_mask"].squeeze(0),
-                "labels": encoded["input_ids"].squeeze(0).clone(),
-            })
+        tensors = {
+            key: torch.cat(chunks) if chunks else torch.zeros(0, dtype=parts_dtypes[key])
+            for key, chunks in parts.items()
+        }
+        lengths = tensors.pop("lengths")
+        tensors["offsets"] = torch.zeros(len(lengths) + 1, dtype=torch.long)
+        tensors["offsets"][1:] = lengths.cumsum(0)
+        return tensors
+
+    def _encode(self, examples: List[Dict[str, Any]], template: Optional[ChatTemplate], concat_ids: bool):
+        """Token ids and prompt lengths for a chunk of examples
+
+        Rows that concatenate cleanly use pre-tokenized frame ids; the rest
+        are tokenized from rendered text.
+        """
+        if not concat_ids:
+            return self._encode_rendered(examples, template)
+
+        safe = [ChatTemplate.concat_safe(ex) for ex in examples]
+        concat_rows = [ex for ex, ok in zip(examples, safe) if ok]
+        rendered_rows = [ex for ex, ok in zip(examples, safe) if not ok]
+        frame_ids, frame_prompts = template.encode(self.tokenizer, concat_rows, self.max_length) if concat_rows else ([], [])
+        rendered_ids, rendered_prompts = self._encode_rendered(rendered_rows, template) if rendered_rows else ([], [])
+
+        # Restore the original row order
+        concat_iter = iter(zip(frame_ids, frame_prompts))
+        rendered_iter = iter(zip(rendered_ids, rendered_prompts))
+        rows = [next(concat_iter) if ok else next(rendered_iter) for ok in safe]
+        return [ids for ids, _ in rows], [p for _, p in rows]
+
+    def _encode_rendered(self, examples: List[Dict[str, Any]], template: Optional[ChatTemplate]):
+        """Tokenize rendered chat text; returns (input_ids, prompt_lengths)"""
+        # No padding here: the collator pads each batch to its longest row.
+        # Each chunk is tokenized in one call so the fast tokenizer can
+        # parallelize across rows.
+        texts, prompt_texts = self._render(examples, template)
+        input_ids = self.tokenizer(
+            texts,
+            truncation=True,
+            max_length=self.max_length,
+            padding=False,
+        )["input_ids"]
+        prompt_ids = self.tokenizer(
+            prompt_texts,
+            truncation=True,
+            max_length=self.max_length,
+            padding=False,
+        )["input_ids"]
+        return input_ids, [len(ids) for ids in prompt_ids]
+
+    def _chat_template(self, examples: List[Dict[str, Any]]) -> Optional[ChatTemplate]:
+        """Pre-rendered chat template, or None if it can't reproduce apply_chat_template"""
+        try:
+            template = ChatTemplate(self.tokenizer)
+            if not template.matches(self.tokenizer, examples):
+                raise ValueError("pre-rendered template output differs from apply_chat_template")
+            return template
+        except ValueError as e:
+            print(f"Warning: Rendering chat template per example ({e})", file=sys.stderr)
+            return None
+
+    def _render(self, examples: List[Dict[str, Any]], template: Optional[ChatTemplate]):
+        """Render full conversation and prompt-only text for each example"""
+        if template is not None:
+            texts = [template.render(ex["query"], ex["response"]) for ex in examples]
+            prompt_texts = [template.render_prompt(ex["query"]) for ex in examples]
+            return texts, prompt_texts
+
+        texts = [
+            self.tokenizer.apply_chat_template(
+                chat_messages(ex["query"], ex["response"]), tokenize=False, add_generation_prompt=False
+            )
+            for ex in examples
+        ]
+        prompt_texts = [
+            self.tokenizer.apply_chat_template(
+                chat_messages(ex["query"]), tokenize=False, add_generation_prompt=True
+            )
+            for ex in examples
+        ]
+        return texts, prompt_texts
 
     def __len__(self):
-        return len(self.examples)
+        return len(self.weights)
 
     def __getitem__(self, idx):
-        return self.tokenized_examples[idx]
-
-    def get_weighted_sampler(self):
-        """Return a weighted sampler for DataLoader"""
-        from torch.utils.data import WeightedRandomSampler
-        return WeightedRandomSampler(
-            weights=self.weights,
-            num_samples=len(self.examples),
-            replacement=True,
-        )
+        start, end = self.offsets[idx].item(), self.offsets[idx + 1].item()
+        input_ids = self.input_ids[start:end].long()
+
+        # Only learn the assistant response; prompt tokens are ignored (-100).
+        # The collator's tokenizer.pad builds the attention mask.
+        labels = input_ids.clone()
+        labels[:self.prompt_lengths[idx]] = -100
+        return {
+            "input_ids": input_ids,
+            "labels": labels,
+        }
+
+    def get_weighted_sampler(self, batch_size: Optional[int] = None):
+        """Return a weighted sampler for DataLoader
+
+        If batch_size is given, sampled indices are grouped so each batch
+        holds examples of similar length (less padding per batch).
+        """
+        sampler = AliasSampler(self.alias_prob, self.alias, num_samples=len(self))
+        if batch_size is None:
+            return sampler
+        return LengthGroupedWeightedSampler(sampler, self.lengths, batch_size)
+
+
+def build_alias_table(weights: np.ndarray):
+    """Build Vose alias tables for O(1) weighted draws
+
+    Returns (prob, alias) arrays such that drawing i uniformly and keeping
+    it with probability prob[i] (else taking alias[i]) samples proportional
+    to weights.
+    """
+    n = len(weights)
+    if n == 0:
+        return np.ones(0, dtype=np.float64), np.zeros(0, dtype=np.int64)
+    scaled = weights * (n / weights.sum())
+
+    prob = np.ones(n, dtype=np.float64)
+    alias = np.arange(n, dtype=np.int64)
+    small = np.flatnonzero(scaled < 1.0).tolist()
+    large = np.flatnonzero(scaled >= 1.0).tolist()
+    while small and large:
+        lo, hi = small.pop(), large.pop()
+        prob[lo] = scaled[lo]
+        alias[lo] = hi
+        scaled[hi] -= 1.0 - scaled[lo]
+        (small if scaled[hi] < 1.0 else large).append(hi)
+    # Leftovers are 1.0 up to rounding error; prob/alias already default to that
+    return prob, alias
+
+
+class AliasSampler(Sampler):
+    """Weighted sampler with replacement using precomputed alias tables
+
+    Draws a whole epoch of indices in one vectorized NumPy call instead of
+    torch.multinomial's O(N) work per draw.
+    """
+
+    def __init__(self, prob: np.ndarray, alias: np.ndarray, num_samples: int):
+        self.prob = prob
+        self.alias = alias
+        self.num_samples = num_samples
+
+    def __len__(self):
+        return self.num_samples
+
+    def __iter__(self):
+        # Seed from torch so Trainer's set_seed() keeps runs reproducible
+        seed = int(torch.empty((), dtype=torch.int64).random_().item())
+        rng = np.random.default_rng(seed)
+        i = rng.integers(len(self.prob), size=self.num_samples)
+        u = rng.random(self.num_samples)
+        yield from np.where(u < self.prob[i], i, self.alias[i]).tolist()
+
+
+class LengthGroupedWeightedSampler(Sampler):
+    """Reorders weighted draws into length-sorted mega-batches
+
+    Indices are drawn from the wrapped sampler, split into chunks of
+    batch_size * mega_batch_mult, and each chunk is sorted by length. This
+    keeps the weighted distribution intact while batching similar lengths.
+    """
+
+    def __init__(self, sampler: Sampler, lengths: List[int], batch_size: int, mega_batch_mult: int = 50):
+        self.sampler = sampler
+        self.lengths = lengths
+        self.mega_batch_size = batch_size * mega_batch_mult
+
+    def __len__(self):
+        return len(self.sampler)
+
+    def __iter__(self):
+        indices = list(self.sampler)
+        for start in range(0, len(indices), self.mega_batch_size):
+            mega_batch = indices[start:start + self.mega_batch_size]
+            mega_batch.sort(key=self.lengths.__getitem__, reverse=True)
+            yield from mega_batch
+
+
+class WeightedTrainer(Trainer):
+    """Trainer that draws training batches from the dataset's weighted sampler"""
+
+    def __init__(self, *args, group_by_length: bool = False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.group_by_length = group_by_length
 
+    def _get_train_sampler(self, *args, **kwargs):
+        batch_size = self.args.per_device_train_batch_size if self.group_by_length else None
+        return self.train_dataset.get_weighted_sampler(batch_size)
 
-def load_training_examples(jsonl_path: Path) -> List[Dict[str, Any]]:
-    """Load weighted examples from JSONL file"""
-    examples = []
-    with open(jsonl_path, "r") as f:
+
+class CPUOffloadAdamW(torch.optim.Optimizer):
+    """AdamW that keeps master weights and optimizer state on the CPU
+
+    Gradients are copied into pinned host buffers, the AdamW update runs on
+    FP32 master weights in host memory, and the results are copied back.
+    LoRA has few trainable parameters, so the CPU step is cheap while the
+    Adam moments no longer occupy GPU memory.
+    """
+
+    def __init__(self, params, lr: float = 1e-3, betas=(0.9, 0.999), eps: float = 1e-8, weight_decay: float = 0.0):
+        super().__init__(params, dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay))
+        pin = torch.cuda.is_available()
+
+        cpu_groups = []
+        self.grad_buffers = {}
+        for group in self.param_groups:
+            masters = []
+            for p in group["params"]:
+                master = torch.empty(p.shape, dtype=torch.float32, pin_memory=pin)
+                master.copy_(p.detach())
+                self.grad_buffers[master] = torch.empty(p.shape, dtype=torch.float32, pin_memory=pin)
+                masters.append(master)
+            cpu_groups.append({**{k: v for k, v in group.items() if k != "params"}, "params": masters})
+        self.cpu_optimizer = torch.optim.AdamW(cpu_groups)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        # Queue every D2H gradient copy, then wait once per device. With
+        # device_map="auto" params can be spread over several GPUs, and
+        # torch.cuda.synchronize() only waits on the current one.
+        devices = set()
+        for group, cpu_group in zip(self.param_groups, self.cpu_optimizer.param_groups):
+            for key in ("lr", "betas", "eps", "weight_decay"):
+                cpu_group[key] = group[key]  # LR schedulers update the outer groups
+            for p, master in zip(group["params"], cpu_group["params"]):
+                if p.grad is None:
+                    master.grad = None
+                    continue
+                master.grad = self.grad_buffers[master]
+                master.grad.copy_(p.grad, non_blocking=True)
+                devices.add(p.grad.device)
+        for device in devices:
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+
+        self.cpu_optimizer.step()
+
+        for group, cpu_group in zip(self.param_groups, self.cpu_optimizer.param_groups):
+            for p, master in zip(group["params"], cpu_group["params"]):
+                if master.grad is not None:
+                    p.copy_(master, non_blocking=True)
+        return loss
+
+    def state_dict(self):
+        return self.cpu_optimizer.state_dict()
+
+    def load_state_dict(self, state_dict):
+        self.cpu_optimizer.load_state_dict(state_dict)
+
+
+def load_base_model(model_name: str, **kwargs):
+    """Load the base model with the fastest available attention kernel
+
+    Tries Flash Attention 2 (GPU only, needs the flash-attn package), then
+    PyTorch SDPA, then eager attention.
+    """
+    implementations = ["sdpa", "eager"]
+    if torch.cuda.is_available():
+        implementations.insert(0, "flash_attention_2")
+
+    for i, attn_implementation in enumerate(implementations):
+        try:
+            model = AutoModelForCausalLM.from_pretrained(
+                model_name,
+                attn_implementation=attn_implementation,
+                **kwargs,
+            )
+        except (ImportError, ValueError) as e:
+            if i == len(implementations) - 1:
+                raise
+            print(f"  {attn_implementation} unavailable ({e}), falling back")
+            continue
+        print(f"  Attention: {attn_implementation}")
+        return model
+
+
+def bf16_supported() -> bool:
+    """Whether to train in BF16 (FP32 exponent range, no loss scaling needed)"""
+    return torch.cuda.is_available() and torch.cuda.is_bf16_supported()
+
+
+def enable_gradient_checkpointing(model, interval: int = 1):
+    """Enable activation checkpointing on every `interval`-th decoder layer
+
+    Checkpointing every layer costs a full extra forward; with interval > 1
+    the remaining layers run normally, trading some memory for throughput.
+    """
+    model.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": False})
+
+    if interval > 1:
+        checkpointed = [m for m in model.modules() if getattr(m, "_gradient_checkpointing_func", None) is not None]
+        # Innermost checkpointing modules (decoder layers on newer transformers,
+        # otherwise the single model that loops over its layers)
+        ids = {id(m) for m in checkpointed}
+        checkpointed = [m for m in checkpointed if not any(id(d) in ids for d in m.modules() if d is not m)]
+        if len(checkpointed) > 1:
+            # Each decoder layer checkpoints itself (GradientCheckpointingLayer):
+            # keep it on for every `interval`-th layer by index
+            for i, layer in enumerate(checkpointed):
+                layer.gradient_checkpointing = i % interval == 0
+        else:
+            # Older transformers: the model loops over layers through a single
+            # _gradient_checkpointing_func. Count calls within one forward and
+            # reset the counter at the start of each forward, so the same
+            # layers are checkpointed every step.
+            owner = checkpointed[0]
+            checkpoint = owner._gradient_checkpointing_func
+            calls = 0
+
+            def reset_calls(module, args):
+                nonlocal calls
+                calls = 0
+
+            @functools.wraps(checkpoint)
+            def interval_checkpoint(function, *args, **kwargs):
+                nonlocal calls
+                calls += 1
+                if (calls - 1) % interval == 0:
+                    return checkpoint(function, *args, **kwargs)
+                return function(*args, **kwargs)
+
+            owner._gradient_checkpointing_func = interval_checkpoint
+            owner.register_forward_pre_hook(reset_calls)
+
+    # Base weights are frozen under LoRA, so inputs must carry grads for
+    # checkpointed segments to backprop into the adapters
+    model.enable_input_require_grads()
+
+
+def tokenize_cache_path(cache_dir: Path, tokenizer, max_length: int, jsonl_path: Path) -> Path:
+    """Cache location keyed by tokenizer, max length and queue contents"""
+    file_hash = hashlib.blake2b(digest_size=16)
+    with open(jsonl_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            file_hash.update(chunk)
+
+    key_material = f"{TOKENIZE_CACHE_VERSION}:{tokenizer.name_or_path}:{max_length}:{file_hash.hexdigest()}"
+    cache_key = hashlib.blake2b(key_material.encode()).hexdigest()[:16]
+    return cache_dir / f"{TOKENIZE_CACHE_PREFIX}{cache_key}.safetensors"
+
+
+def save_tokenize_cache(tensors: Dict[str, torch.Tensor], cache_path: Path, keep: int = 3) -> bool:
+    """Write the tokenized dataset atomically (see save_safetensors_atomic)
+
+    Returns whether the cache file was written.
+
+    The queue is archived after each successful run, so old keys are rarely
+    hit again; only the `keep` most recently written entries are retained.
+    Other files in the cache directory are never removed.
+    """
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        save_safetensors_atomic(tensors, cache_path)
+    except (OSError, ValueError) as e:
+        print(f"Warning: Failed to write tokenize cache {cache_path}: {e}", file=sys.stderr)
+        return False
+
+    # Evict stale entries, newest first
+    try:
+        entries = sorted(cache_path.parent.glob(f"{TOKENIZE_CACHE_PREFIX}*.safetensors"), key=lambda p: p.stat().st_mtime, reverse=True)
+        for stale in entries[keep:]:
+            if stale != cache_path:
+                stale.unlink(missing_ok=True)
+    except OSError as e:
+        print(f"Warning: Failed to evict old tokenize cache entries: {e}", file=sys.stderr)
+    return True
+
+
+def example_weights(examples: List[Dict[str, Any]]) -> np.ndarray:
+    """Collect per-example weights (default 1.0) into a float array"""
+    return np.fromiter((ex.get("weight", 1.0) for ex in examples), dtype=np.float64, count=len(examples))
+
+
+def iter_training_examples(jsonl_path: Path) -> Iterator[Dict[str, Any]]:
+    """Stream valid examples from JSONL file one line at a time"""
+    with open(jsonl_path, "rb", buffering=1 << 20) as f:
         for line_num, line in enumerate(f, 1):
             try:
-                example = json.loads(line)
-                # Validate required fields
-                if "query" not in example or "response" not in example:
-                    print(f"Warning: Line {line_num} missing query/response, skipping", file=sys.stderr)
-                    continue
-                examples.append(example)
-            except json.JSONDecodeError as e:
+                example = _json_loads(line)
+            except json.JSONDecodeError as e:  # orjson.JSONDecodeError subclasses this
                 print(f"Warning: Line {line_num} invalid JSON: {e}, skipping", file=sys.stderr)
                 continue
+            # Validate required fields
+            if "query" not in example or "response" not in example:
+                print(f"Warning: Line {line_num} missing query/response, skipping", file=sys.stderr)
+                continue
+            yield example
 
-    print(f"Loaded {len(examples)} training examples")
 
-    # Print weight distribution
-    weights = [ex.get("weight", 1.0) for ex in examples]
+def print_weight_distribution(w: np.ndarray):
+    """Print summary statistics of example weights"""
     print(f"Weight distribution:")
-    print(f"  Min: {min(weights):.1f}")
-    print(f"  Max: {max(weights):.1f}")
-    print(f"  Mean: {sum(weights) / len(weights):.1f}")
-    print(f"  High-weight (≥10): {sum(1 for w in weights if w >= 10)}")
-    print(f"  Medium-weight (3-9): {sum(1 for w in weights if 3 <= w < 10)}")
-    print(f"  Normal-weight (1-2): {sum(1 for w in weights if w < 3)}")
-
-    return examples
+    print(f"  Min: {w.min():.1f}")
+    print(f"  Max: {w.max():.1f}")
+    print(f"  Mean: {w.mean():.1f}")
+    print(f"  High-weight (≥10): {(w >= 10).sum()}")
+    print(f"  Medium-weight (3-9): {((w >= 3) & (w < 10)).sum()}")
+    print(f"  Normal-weight (1-2): {(w < 3).sum()}")
 
 
 def train_lora(
@@ -143,48 +704,86 @@ def train_lora(
     output_dir: Path,
     epochs: int = 3,
     batch_size: int = 4,
+    gradient_accumulation_steps: int = 1,
     learning_rate: float = 1e-4,
+    group_by_length: bool = False,
+    compile_model: bool = False,
+    offload_optimizer: bool = False,
 ) -> PeftModel:
     """Train LoRA adapter on weighted examples"""
+    num_workers = min(4, (os.cpu_count() or 1) // 2)  # Collate batches off the main thread
 
     print(f"\nTraining Configuration:")
     print(f"  Epochs: {epochs}")
     print(f"  Batch size: {batch_size}")
+    print(f"  Gradient accumulation steps: {gradient_accumulation_steps}")
     print(f"  Learning rate: {learning_rate}")
+    print(f"  Group by length: {group_by_length}")
+    print(f"  torch.compile: {compile_model}")
+    print(f"  CPU optimizer offload: {offload_optimizer}")
+    print(f"  DataLoader workers: {num_workers}")
     print(f"  Examples: {len(dataset)}")
-    print(f"  Total training steps: {(len(dataset) // batch_size) * epochs}")
-
-    # Create weighted sampler
-    sampler = dataset.get_weighted_sampler()
+    print(f"  Total training steps: {(len(dataset) // (batch_size * gradient_accumulation_steps)) * epochs}")
 
     # Training arguments
+    use_bf16 = bf16_supported()
     training_args = TrainingArguments(
         output_dir=str(output_dir / "checkpoints"),
         num_train_epochs=epochs,
         per_device_train_batch_size=batch_size,
-        gradient_accumulation_steps=1,
+        gradient_accumulation_steps=gradient_accumulation_steps,
         learning_rate=learning_rate,
         warmup_steps=10,
         logging_steps=5,
         save_steps=50,
         save_total_limit=2,
-        fp16=torch.cuda.is_available(),  # Use FP16 on GPU
+        bf16=use_bf16,  # Prefer BF16 on Ampere+ GPUs
+        fp16=torch.cuda.is_available() and not use_bf16,  # Fall back to FP16 on older GPUs
+        dataloader_num_workers=num_workers,
+        dataloader_pin_memory=torch.cuda.is_available(),  # Faster async H2D copies
+        dataloader_persistent_workers=num_workers > 0,
+        dataloader_prefetch_factor=4 if num_workers > 0 else None,
         report_to="none",  # Don't report to wandb/tensorboard
         remove_unused_columns=False,
     )
 
-    # Data collator (handles batching)
-    data_collator = DataCollatorForLanguageModeling(
+    # Data collator (pads each batch to its longest row; labels padded with -100).
+    # When compiling, round lengths up to a multiple of 64 so only a handful of
+    # distinct shapes (at most max_length / 64) are ever compiled.
+    data_collator = DataCollatorForSeq2Seq(
         tokenizer=tokenizer,
-        mlm=False,  # We're doing causal LM, not masked LM
+        padding="longest",
+        pad_to_multiple_of=64 if compile_model else None,
+        label_pad_token_id=-100,
     )
 
-    # Create trainer
-    trainer = Trainer(
-        model=model,
+    # Optionally keep AdamW state in host memory to free GPU memory for activations
+    optimizers = (None, None)
+    if offload_optimizer:
+        trainable = [p for p in model.parameters() if p.requires_grad]
+        optimizers = (
+            CPUOffloadAdamW(trainable, lr=learning_rate, weight_decay=training_args.weight_decay),
+            None,  # Trainer builds the LR scheduler around our optimizer
+        )
+
+    # Compile for fused kernels (LoRA A·B + scaling + add). Default mode, not
+    # "reduce-overhead": CUDA graphs would be recorded (with their own memory
+    # pool) per padded length. Warmup costs minutes, so this only pays off on
+    # long runs. The uncompiled PeftModel is still returned so exported names
+    # stay clean.
+    train_model = model
+    if compile_model:
+        torch._dynamo.config.cache_size_limit = 64
+        train_model = torch.compile(model, dynamic=False)
+
+    # Create trainer (samples examples proportional to their weight)
+    trainer = WeightedTrainer(
+        model=train_model,
         args=training_args,
         train_dataset=dataset,
         data_collator=data_collator,
+        optimizers=optimizers,
+        group_by_length=group_by_length,
     )
 
     # Train
@@ -195,15 +794,139 @@ def train_lora(
     return model
 
 
+def copy_to_host(tensors: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+    """Copy tensors into pinned host memory, synchronizing once at the end"""
+    if not torch.cuda.is_available():
+        return {name: t.cpu() for name, t in tensors.items()}
+
+    host = {name: torch.empty(t.shape, dtype=t.dtype, pin_memory=True) for name, t in tensors.items()}
+
+    # device_map="auto" may spread weights over several GPUs; a stream only
+    # orders work on its own device, so use one copy stream per GPU
+    by_device = {}
+    for name, t in tensors.items():
+        by_device.setdefault(t.device, []).append(name)
+
+    streams = []
+    for device, names in by_device.items():
+        if device.type != "cuda":
+            for name in names:
+                host[name].copy_(tensors[name])
+            continue
+        stream = torch.cuda.Stream(device)
+        stream.wait_stream(torch.cuda.current_stream(device))  # Don't read weights mid-update
+        with torch.cuda.stream(stream):
+            for name in names:
+                host[name].copy_(tensors[name], non_blocking=True)
+        streams.append(stream)
+    for stream in streams:
+        stream.synchronize()
+    return host
+
+
+SAFETENSORS_DTYPES = {
+    torch.float64: "F64",
+    torch.float32: "F32",
+    torch.float16: "F16",
+    torch.bfloat16: "BF16",
+    torch.int64: "I64",
+    torch.int32: "I32",
+    torch.int16: "I16",
+    torch.int8: "I8",
+    torch.uint8: "U8",
+    torch.bool: "BOOL",
+}
+
+
+def save_safetensors_atomic(tensors: Dict[str, torch.Tensor], output_path: Path):
+    """Write a safetensors file through a preallocated mmap and publish it atomically
+
+    The header and offsets are computed up front, the file is preallocated
+    and mapped once, and each tensor's bytes are copied straight into the
+    map. The temp file is fsynced and read back with safetensors before it
+    is renamed over output_path, and the directory is fsynced so the rename
+    survives a crash. Readers see either the previous file or the complete
+    new one.
+    """
+    header = {}
+    data_size = 0
+    for name, t in tensors.items():
+        nbytes = t.numel() * t.element_size()
+        header[name] = {
+            "dtype": SAFETENSORS_DTYPES[t.dtype],
+            "shape": list(t.shape),
+            "data_offsets": [data_size, data_size + nbytes],
+        }
+        data_size += nbytes
+    header_bytes = json.dumps(header, separators=(",", ":")).encode()
+    header_bytes += b" " * (-len(header_bytes) % 8)  # Keep tensor data 8-byte aligned
+    data_start = 8 + len(header_bytes)
+    total_size = data_start + data_size
+
+    tmp_path = output_path.with_name(f"{output_path.name}.{os.getpid()}.tmp")
+    fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        try:
+            try:
+                os.posix_fallocate(fd, 0, total_size)
+            except (AttributeError, OSError):  # Not available on macOS / some filesystems
+                os.ftruncate(fd, total_size)
+
+            with mmap.mmap(fd, total_size) as mm:
+                mm[:8] = struct.pack("<Q", len(header_bytes))
+                mm[8:data_start] = header_bytes
+                for name, t in tensors.items():
+                    start, end = header[name]["data_offsets"]
+                    if end > start:
+                        mm[data_start + start:data_start + end] = tensor_bytes(t).numpy()
+                mm.flush()
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        check_safetensors_roundtrip(tmp_path, tensors)
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    fsync_directory(output_path.parent)
+
+
+def tensor_bytes(t: torch.Tensor) -> torch.Tensor:
+    """Flat uint8 view of a tensor's storage (works for bf16 and bool too)"""
+    return t.contiguous().reshape(-1).view(torch.uint8)
+
+
+def check_safetensors_roundtrip(path: Path, tensors: Dict[str, torch.Tensor]):
+    """Read a written file back with safetensors and compare it bit for bit"""
+    loaded = load_file(str(path), device="cpu")
+    if loaded.keys() != tensors.keys():
+        raise ValueError(f"safetensors round-trip mismatch in {path}: tensor names differ")
+    for name, t in tensors.items():
+        # Compare raw bytes so NaNs in the weights don't count as a mismatch
+        if loaded[name].dtype != t.dtype or loaded[name].shape != t.shape or \
+                not torch.equal(tensor_bytes(loaded[name]), tensor_bytes(t.cpu())):
+            raise ValueError(f"safetensors round-trip mismatch in {path}: {name}")
+
+
+def fsync_directory(path: Path):
+    """Flush a directory entry (e.g. after a rename) to disk"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
 def export_adapter(model: PeftModel, output_path: Path):
     """Export LoRA adapter weights to safetensors"""
     print(f"\nExporting adapter to {output_path}")
 
-    # Get adapter state dict (only LoRA parameters)
-    adapter_state_dict = {}
-    for name, param in model.named_parameters():
-        if "lora" in name.lower():
-            adapter_state_dict[name] = param.detach().cpu()
+    # Get adapter state dict (only LoRA parameters, adapter name stripped)
+    adapter_state_dict = copy_to_host({
+        name: param.detach()
+        for name, param in get_peft_model_state_dict(model).items()
+    })
 
     print(f"Adapter contains {len(adapter_state_dict)} parameters")
 
@@ -212,9 +935,9 @@ def export_adapter(model: PeftModel, output_path: Path):
     total_size_mb = sum(p.numel() * p.element_size() for p in adapter_state_dict.values()) / (1024 * 1024)
     print(f"Total parameters: {total_params:,} ({total_size_mb:.2f} MB)")
 
-    # Save to safetensors
+    # Save to safetensors (atomically, the Rust runtime may be watching this path)
     output_path.parent.mkdir(parents=True, exist_ok=True)
-    save_file(adapter_state_dict, str(output_path))
+    save_safetensors_atomic(adapter_state_dict, output_path)
 
     print(f"✅ Adapter saved successfully!")
 
@@ -229,7 +952,24 @@ def main():
     parser.add_argument("--dropout", type=float, default=0.05, help="LoRA dropout (default: 0.05)")
     parser.add_argument("--epochs", type=int, default=3, help="Training epochs (default: 3)")
     parser.add_argument("--batch-size", type=int, default=4, help="Batch size (default: 4)")
+    parser.add_argument("--gradient-accumulation-steps", type=int, default=1,
+                        help="Batches to accumulate per optimizer step (default: 1)")
     parser.add_argument("--learning-rate", type=float, default=1e-4, help="Learning rate (default: 1e-4)")
+    parser.add_argument("--max-length", type=int, default=512, help="Max tokens per example (default: 512)")
+    parser.add_argument("--group-by-length", action="store_true", help="Batch examples of similar length to reduce padding")
+    parser.add_argument("--gradient-checkpointing", action="store_true",
+                        help="Enable activation checkpointing to fit larger batches")
+    parser.add_argument("--gradient-checkpointing-interval", type=int, default=1,
+                        help="Checkpoint every Nth layer when checkpointing is enabled (default: 1)")
+    parser.add_argument("--offload-optimizer", action="store_true",
+                        help="Keep optimizer state in CPU memory to save GPU memory")
+    parser.add_argument("--tokenize-cache-dir", type=Path, default=Path.home() / ".shammah" / "tok_cache",
+                        help="Directory for cached tokenized datasets (default: ~/.shammah/tok_cache)")
+    parser.add_argument("--no-tokenize-cache", action="store_true", help="Always re-tokenize the training queue")
+    parser.add_argument("--load-in-4bit", action="store_true",
+                        help="Quantize the frozen base model to 4-bit NF4 (QLoRA, requires bitsandbytes)")
+    parser.add_argument("--compile", action="store_true",
+                        help="Compile the model with torch.compile on GPU (slow warmup, helps long runs)")
 
     args = parser.parse_args()
 
@@ -238,29 +978,74 @@ def main():
         print(f"Error: Training queue not found: {args.queue_jsonl}", file=sys.stderr)
         sys.exit(1)
 
+    if args.load_in_4bit:
+        if not torch.cuda.is_available():
+            print("Error: --load-in-4bit requires a CUDA GPU", file=sys.stderr)
+            sys.exit(1)
+        if args.compile:
+            print("Error: --load-in-4bit cannot be combined with --compile "
+                  "(bitsandbytes-quantized PEFT models fail to compile)", file=sys.stderr)
+            sys.exit(1)
+        if importlib.util.find_spec("bitsandbytes") is None:
+            print("Error: --load-in-4bit requires bitsandbytes", file=sys.stderr)
+            print("\nPlease install it:", file=sys.stderr)
+            print("  pip install bitsandbytes", file=sys.stderr)
+            sys.exit(1)
+
     print("=" * 60)
     print("LoRA Fine-Tuning for Qwen Models")
     print("=" * 60)
 
-    # Load examples
+    # Load tokenizer
+    print(f"\n🔧 Loading tokenizer from {args.base_model}")
+    tokenizer = AutoTokenizer.from_pretrained(args.base_model, use_fast=True)
+    if not tokenizer.is_fast:
+        print("Warning: Fast tokenizer unavailable, dataset tokenization will be slow", file=sys.stderr)
+
+    # Stream examples straight into the tokenized dataset
     print(f"\n📖 Loading training examples from {args.queue_jsonl}")
-    examples = load_training_examples(args.queue_jsonl)
+    cache_path = None
+    if not args.no_tokenize_cache:
+        cache_path = tokenize_cache_path(args.tokenize_cache_dir, tokenizer, args.max_length, args.queue_jsonl)
+    dataset = WeightedExampleDataset(
+        iter_training_examples(args.queue_jsonl),
+        tokenizer,
+        max_length=args.max_length,
+        cache_path=cache_path,
+    )
 
-    if len(examples) == 0:
+    if len(dataset) == 0:
         print("Error: No valid examples found in training queue", file=sys.stderr)
         sys.exit(1)
 
-    # Load tokenizer
-    print(f"\n🔧 Loading tokenizer from {args.base_model}")
-    tokenizer = AutoTokenizer.from_pretrained(args.base_model)
+    print(f"Loaded {len(dataset)} training examples")
+    print_weight_distribution(dataset.weights)
 
     # Load base model
     print(f"\n🤖 Loading base model from {args.base_model}")
-    model = AutoModelForCausalLM.from_pretrained(
+    compute_dtype = torch.bfloat16 if bf16_supported() else (torch.float16 if torch.cuda.is_available() else torch.float32)
+    quantization_config = None
+    if args.load_in_4bit:
+        # QLoRA: NF4-quantized frozen base, LoRA adapters trained in higher precision
+        print(f"  Quantization: 4-bit NF4 (compute dtype: {compute_dtype})")
+        quantization_config = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=compute_dtype,
+            bnb_4bit_use_double_quant=True,
+        )
+    model = load_base_model(
         args.base_model,
-        torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
+        torch_dtype=compute_dtype,
         device_map="auto" if torch.cuda.is_available() else None,
+        quantization_config=quantization_config,
     )
+    if args.load_in_4bit:
+        model = prepare_model_for_kbit_training(
+            model,
+            use_gradient_checkpointing=args.gradient_checkpointing,
+            gradient_checkpointing_kwargs={"use_reentrant": False},
+        )
 
     # Configure LoRA
     print(f"\n⚙️  Configuring LoRA")
@@ -281,9 +1066,9 @@ def main():
     model = get_peft_model(model, lora_config)
     model.print_trainable_parameters()
 
-    # Create dataset
-    print(f"\n📚 Creating weighted dataset")
-    dataset = WeightedExampleDataset(examples, tokenizer)
+    if args.gradient_checkpointing:
+        print(f"  Gradient checkpointing: every {args.gradient_checkpointing_interval} layer(s)")
+        enable_gradient_checkpointing(model, args.gradient_checkpointing_interval)
 
     # Train
     trained_model = train_lora(
@@ -293,7 +1078,11 @@ def main():
         args.output_adapter.parent,
         epochs=args.epochs,
         batch_size=args.batch_size,
+        gradient_accumulation_steps=args.gradient_accumulation_steps,
         learning_rate=args.learning_rate,
+        group_by_length=args.group_by_length,
+        compile_model=args.compile and torch.cuda.is_available(),
+        offload_optimizer=args.offload_optimizer,
     )
 
     # Export adapter